@@ -1,8 +1,193 @@
 import asyncio
+import fnmatch
+import re
+import sys
+import time
 from collections import Counter
+from email.utils import parsedate_to_datetime
+from functools import cached_property
 
 import yaml
-from requests import HTTPError
+from requests import HTTPError, RequestException
+
+# Type names never change, so they are resolved once and kept for the lifetime of the process
+type_names = {}
+type_ids = {}
+
+
+def type_name(type_id):
+    return type_names.get(type_id, "Unknown Item")
+
+
+def resolve_type_names(preston, ids):
+    """Fetches the names of all type ids that have not been resolved yet and returns the number of requests."""
+    unknown_ids = set(ids) - type_names.keys()
+    for type_id in unknown_ids:
+        response = preston.get_op('get_universe_types_type_id', type_id=type_id)
+        try:
+            type_names[response["type_id"]] = response["name"]
+            type_ids[response["name"].lower()] = response["type_id"]
+        except KeyError:
+            pass
+
+    return len(unknown_ids)
+
+
+def resolve_type_ids(preston, names):
+    """Fetches the type ids of all item names that have not been resolved yet and returns the number of requests.
+
+    Raises ValueError if ESI can't be reached, since every item would show up as missing otherwise.
+    """
+    unknown_names = list(set(str(name) for name in names if str(name).lower() not in type_ids))
+
+    # ESI accepts at most 500 names per request
+    for start in range(0, len(unknown_names), 500):
+        try:
+            result = preston.post_op(
+                'post_universe_ids',
+                path_data={},
+                post_data=unknown_names[start:start + 500]
+            )
+        except RequestException as e:
+            raise ValueError(f"Could not look up item names on ESI, try again later ({e})")
+
+        try:
+            for type_data in result.get("inventory_types", []):
+                type_ids[type_data["name"].lower()] = type_data["id"]
+                type_names[type_data["id"]] = type_data["name"]
+        except (AttributeError, KeyError):
+            pass
+
+    return len(range(0, len(unknown_names), 500))
+
+
+def display_name(key):
+    """Returns the name of a requirement key, which is either a type id or an unresolved item name."""
+    return type_name(key) if isinstance(key, int) else key
+
+
+class Requirements:
+    """Requirements compiled into an index, so each container is only matched against targets that can apply.
+
+    Besides the exact "Name (Type)" of a container, targets can be templates that match any container
+    with a given ship type ("type: Ishtar"), a glob or regex on the full name ("glob: Fleet * (Ishtar)",
+    "regex: Fleet \\d+ \\(.*\\)") or a location flag ("flag: CorpSAG3"). A container matches the most
+    specific target: exact names first, then patterns in file order, then types and finally flags.
+    """
+
+    TEMPLATE_PREFIXES = ["type", "glob", "regex", "flag"]
+
+    # Patterns are grouped by this many characters of the literal text they start with
+    PATTERN_KEY_LENGTH = 3
+
+    def __init__(self):
+        self.order = {}
+        self.exact = {}
+        self.types = {}
+        self.flags = {}
+        self.patterns = []
+        self.keyed_patterns = {}
+        self.unkeyed_patterns = []
+
+        # Number of ESI requests made to resolve the item names
+        self.esi_calls = 0
+
+    def add(self, target_name, contents):
+        self.order.setdefault(target_name, len(self.order))
+
+        prefix, _, value = str(target_name).partition(":")
+        prefix, value = prefix.strip().lower(), value.strip()
+
+        if prefix == "type":
+            type_id = type_ids.get(value.lower())
+            if type_id is None:
+                raise ValueError(f"Unknown ship type in `{target_name}`")
+            self.types.setdefault(type_id, (target_name, contents))
+        elif prefix == "flag":
+            self.flags.setdefault(value, (target_name, contents))
+        elif prefix in ["glob", "regex"]:
+            expression = fnmatch.translate(value) if prefix == "glob" else value
+            try:
+                pattern = re.compile(expression)
+            except re.error as e:
+                raise ValueError(f"Invalid pattern `{target_name}`: {e}")
+            literal = glob_literal_prefix(value) if prefix == "glob" else regex_literal_prefix(value)
+            self.patterns.append((literal, pattern, target_name, contents))
+        else:
+            self.exact[target_name] = (target_name, contents)
+
+    def build(self):
+        """Groups the patterns by the literal text they start with, so a name is only tested against few of them."""
+        for index, (literal, pattern, target_name, contents) in enumerate(self.patterns):
+            entry = (index, pattern, target_name, contents)
+            if len(literal) >= self.PATTERN_KEY_LENGTH:
+                self.keyed_patterns.setdefault(literal[:self.PATTERN_KEY_LENGTH], []).append(entry)
+            else:
+                self.unkeyed_patterns.append(entry)
+
+    def match(self, item):
+        """Returns the target name and the required contents for a container, or None if nothing applies."""
+        if item.full_name in self.exact:
+            return self.exact[item.full_name]
+
+        if self.patterns:
+            candidates = self.keyed_patterns.get(item.full_name[:self.PATTERN_KEY_LENGTH], []) + self.unkeyed_patterns
+            for index, pattern, target_name, contents in sorted(candidates, key=lambda x: x[0]):
+                if pattern.fullmatch(item.full_name):
+                    return target_name, contents
+
+        if item.type_id in self.types:
+            return self.types[item.type_id]
+
+        return self.flags.get(item.location_flag)
+
+
+def glob_literal_prefix(value):
+    """Returns the text every name matching the glob starts with."""
+    return re.split(r"[*?\[]", value, maxsplit=1)[0]
+
+
+def regex_literal_prefix(value):
+    """Returns the text every name matching the regex starts with, or nothing if that is not obvious."""
+    # Alternatives and inline flags can change what the start has to be
+    if "|" in value or value.startswith("(?"):
+        return ""
+
+    literal = re.match(r"[^.^$*+?{}\[\]\\|()]*", value).group()
+
+    # A quantifier makes the last literal character optional
+    if value[len(literal):len(literal) + 1] in ["*", "?", "{"]:
+        literal = literal[:-1]
+    return literal
+
+
+def format_missing(difference):
+    return "".join(f"\n- Missing {count}x {display_name(key)}" for key, count in difference.items())
+
+
+def compile_requirements(preston, yaml_text):
+    """Parses the requirements YAML into an index and keys the contents of each target by type id.
+
+    Item names that can't be resolved are kept as they are, so they still show up as missing.
+    Raises ValueError if a pattern template is not a valid expression or ESI can't be reached.
+    """
+    requirements = yaml.load(yaml_text, Loader=yaml.CLoader) or {}
+
+    names = [name for contents in requirements.values() for name in (contents or {})]
+    names += [
+        str(target_name).partition(":")[2].strip() for target_name in requirements
+        if str(target_name).partition(":")[0].strip().lower() == "type"
+    ]
+    compiled = Requirements()
+    compiled.esi_calls = resolve_type_ids(preston, names)
+    for target_name, target_contents in requirements.items():
+        counter = Counter()
+        for name, count in (target_contents or {}).items():
+            counter[type_ids.get(str(name).lower(), name)] += count
+        compiled.add(target_name, counter)
+    compiled.build()
+
+    return compiled
 
 
 class Item:
@@ -16,7 +201,6 @@ class Item:
         self.type_id = type_id
         self.subordinates = []
         self.name = ""
-        self.type_name = ""
 
     def add_subordinate(self, subordinate):
         self.subordinates.append(subordinate)
@@ -25,11 +209,15 @@ class Item:
         ret = f"Item(item_id={self.item_id}, type_id={self.type_id}"
         if self.name != "":
             ret += f", name={self.name}"
-        if self.type_name != "":
+        if self.type_id in type_names:
             ret += f", type_name={self.type_name}"
         ret += ")"
         return ret
 
+    @property
+    def type_name(self):
+        return type_name(self.type_id)
+
     @property
     def full_name(self):
         return f"{self.name} ({self.type_name})"
@@ -50,32 +238,47 @@ class Item:
 
         return False
 
+    @cached_property
+    def type_id_counts(self):
+        counter = Counter()
+
+        for subordinate in self.subordinates:
+            counter[subordinate.type_id] += subordinate.quantity
+            counter.update(subordinate.type_id_counts)
+
+        return counter
+
     @property
     def item_counts(self):
         counter = Counter()
 
-        for subordinate in self.subordinates:
-            counter += Counter({subordinate.type_name: subordinate.quantity})
-            counter += subordinate.item_counts
+        for type_id, count in self.type_id_counts.items():
+            counter[type_name(type_id)] += count
 
         return counter
 
     @property
     def total_item_count(self):
-        return sum(self.item_counts.values())
+        return sum(self.type_id_counts.values())
 
 
 class Assets:
-    def __init__(self, preston):
+    def __init__(self, preston, public_preston=None):
 
         self.preston = preston
 
+        # Public lookups go through an unauthenticated client, so a cached snapshot never refreshes tokens
+        self.public_preston = public_preston or preston
+
         # Set up initial info
         character_data = preston.whoami()
         self.character_id = character_data["character_id"]
         self.character_name = character_data["character_name"]
         self.is_corporation = character_data["scopes"] == "esi-assets.read_corporation_assets.v1"
 
+        # Number of ESI requests made to build this snapshot, starting with the token refresh and whoami
+        self.esi_calls = 2
+
         if self.is_corporation:
             self.corporation_id = preston.get_op(
                 'get_characters_character_id',
@@ -86,12 +289,39 @@ class Assets:
                 'get_corporations_corporation_id',
                 corporation_id=self.corporation_id
             ).get("name")
+            self.esi_calls += 2
 
         self.items = []
         self.root_items = []
         self.items_of_interest = []
         self.corp_hangars = []
 
+        # ESI caches assets for an hour, this is updated from the response headers on fetch
+        self.expires = time.time() + 3600
+        self.fetched_at = None
+
+    @property
+    def owner_key(self):
+        """Identifies whose assets these are.
+
+        Corporation assets include the character that fetched them, since ESI only checks the role of that
+        character when the request is made, so a snapshot must never be handed to another member.
+        """
+        if self.is_corporation:
+            return "corporation", str(self.corporation_id), str(self.character_id)
+        return "character", str(self.character_id)
+
+    @property
+    def approximate_size(self):
+        """Rough memory use of the processed snapshot in bytes."""
+        size = sum(sys.getsizeof(x) for x in [self, self.__dict__, self.items, self.root_items, self.items_of_interest])
+        for item in self.items:
+            size += sys.getsizeof(item) + sys.getsizeof(item.__dict__) + sys.getsizeof(item.subordinates)
+            size += sys.getsizeof(item.name) + sys.getsizeof(item.location_flag)
+            if "type_id_counts" in item.__dict__:
+                size += sys.getsizeof(item.type_id_counts)
+        return size
+
     async def fetch(self):
         loop = asyncio.get_event_loop()
         await loop.run_in_executor(None, self.sync_fetch)
@@ -100,6 +330,7 @@ class Assets:
         # Fetch all available assets
         page = 1
         while True:
+            self.esi_calls += 1
             try:
                 if self.is_corporation:
                     result = self.preston.get_op('get_corporations_corporation_id_assets', corporation_id=self.corporation_id,
@@ -107,12 +338,17 @@ class Assets:
                 else:
                     result = self.preston.get_op('get_characters_character_id_assets', character_id=self.character_id, page=page)
             except HTTPError as exp:
+                # Past the last page, any other error would otherwise request the same page forever
                 if exp.response.status_code == 404:
                     break
+                raise
             else:
                 self.items.extend([Item(**x) for x in result])
                 page += 1
 
+                if page == 2:
+                    self.update_expiry()
+
         # Index items by id for quick finding
         id_items = {x.item_id: x for x in self.items}
 
@@ -140,27 +376,34 @@ class Assets:
                 post_data=[x.item_id for x in self.items_of_interest]
             )
 
+        self.esi_calls += 1
+
         try:
             for item_data in result:
                 id_items[item_data["item_id"]].name = item_data["name"].replace("&gt;", ">").replace("&lt;", "<")
         except TypeError:
             pass
 
-        # Fetch all type names and add them to the items
-        type_ids = set([x.type_id for x in self.items])
-        type_id_names = {}
-        for type_id in type_ids:
-            response = self.preston.get_op('get_universe_types_type_id', type_id=type_id)
-            try:
-                type_id_names[response["type_id"]] = response["name"]
-            except KeyError:
-                pass
+        # Only containers need their type name right away, contents are resolved when they are displayed
+        self.esi_calls += resolve_type_names(self.public_preston, [x.type_id for x in self.items_of_interest])
 
-        for item in self.items:
-            item.type_name = type_id_names.get(item.type_id, "Unknown Item")
+        # Count the contents of all containers now, so the snapshot size includes them before it is cached
+        for item in self.items_of_interest:
+            item.type_id_counts
+
+        self.fetched_at = time.time()
+
+    def update_expiry(self):
+        """Takes the expiry of the last ESI response, which is when new assets can be fetched."""
+        try:
+            self.expires = parsedate_to_datetime(self.preston.stored_headers[0]["expires"]).timestamp()
+        except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+            pass
 
     def save_requirement(self):
         """Generates and returns the requirements as a YAML string."""
+        resolve_type_names(self.public_preston, [x.type_id for x in self.items])
+
         state = {}
         for ship in self.items_of_interest:
             # If there are multiple containers with the same name take the fullest one
@@ -169,38 +412,47 @@ class Assets:
 
         return yaml.dump(state, Dumper=yaml.CDumper)
 
-    def check_requirement(self, yaml_text):
-        """Checks the state according to the requirements and returns any mismatches."""
-        requirements = yaml.load(yaml_text, Loader=yaml.CLoader)
+    def matched_containers(self, requirements):
+        """Yields each container that has requirements together with them, in the order of the requirements."""
+        matches = []
+        for position, ship in enumerate(self.items_of_interest):
+            match = requirements.match(ship)
+            if match is not None:
+                target_name, contents = match
+                matches.append((requirements.order[target_name], position, ship, contents))
+
+        for target_position, position, ship, contents in sorted(matches, key=lambda x: x[:2]):
+            yield ship, contents
+
+    def get_missing(self, requirements):
+        """Yields each container that has requirements together with the items missing from it."""
+        for ship, target_contents in self.matched_containers(requirements):
+            difference = target_contents - ship.type_id_counts
+            resolve_type_names(self.public_preston, [x for x in difference if isinstance(x, int)])
+            yield ship, difference
 
-        for target_name, target_contents in requirements.items():
-            for ship in self.items_of_interest:
-                if ship.full_name == target_name:
-                    difference = Counter(target_contents) - ship.item_counts
+    def check_requirement(self, requirements):
+        """Checks the state according to the requirements and returns any mismatches.
 
-                    out = f"### {ship.full_name}:"
-                    has_missing = False
-                    for name, count in difference.items():
-                        if count > 0:
-                            has_missing = True
-                            out += f"\n- Missing {count}x {name}"
+        The requirements can either be the YAML text or the output of compile_requirements.
+        """
+        if isinstance(requirements, str):
+            requirements = compile_requirements(self.public_preston, requirements)
 
-                    if has_missing:
-                        yield out
+        for ship, difference in self.get_missing(requirements):
+            if difference:
+                yield f"### {ship.full_name}:{format_missing(difference)}"
 
-    def get_buy_list(self, yaml_text, buy_list=None):
-        """Generates a buy list based on the requirements in the provided YAML text."""
+    def get_buy_list(self, requirements, buy_list=None):
+        """Generates a buy list based on the requirements in the provided YAML text or compiled requirements."""
 
         # Check if a previous buy list was passed, otherwise create an empty one
         buy_list = buy_list or Counter()
 
-        requirements = yaml.load(yaml_text, Loader=yaml.CLoader)
+        if isinstance(requirements, str):
+            requirements = compile_requirements(self.public_preston, requirements)
 
-        for target_name, target_contents in requirements.items():
-            for ship in self.items_of_interest:
-                if ship.full_name == target_name:
-                    difference = Counter(target_contents) - ship.item_counts
-                    missing = Counter({k: max(0, v) for k, v in difference.items()})
-                    buy_list += missing
+        for ship, difference in self.get_missing(requirements):
+            buy_list += Counter({display_name(k): v for k, v in difference.items()})
 
         return buy_list
@@ -1,16 +1,105 @@
+import asyncio
 import logging
 
 from aiohttp import web
 from discord.ext import tasks
 from preston import Preston
 
+import esi_spec
+from assets import Assets
 from models import User, Character, Challenge, CorporationCharacter
+from snapshot_cache import snapshots
 
 # Configure the logger
 logger = logging.getLogger('callback')
 logger.setLevel(logging.INFO)
 
 
+# How many callbacks are processed at once, the rest wait so a burst of logins can't exhaust the executor
+CALLBACK_CONCURRENCY = 4
+PRIME_CONCURRENCY = 2
+
+callback_semaphore = asyncio.Semaphore(CALLBACK_CONCURRENCY)
+prime_semaphore = asyncio.Semaphore(PRIME_CONCURRENCY)
+
+# Keep references to background tasks so they are not garbage collected before they finish
+background_tasks = set()
+
+
+def register_character(preston: Preston, code: str, state: str):
+    """Verifies a login and stores the character. Returns the response status, text and authenticated client."""
+
+    # Verify the state and get the user ID
+    challenge = Challenge.get_or_none(Challenge.state == state)
+    if not challenge:
+        logger.warning("Failed to verify challenge")
+        return 403, "Authentication failed: State mismatch", None
+
+    # Authenticate using the code
+    try:
+        auth = esi_spec.attach(preston.authenticate(code))
+    except Exception as e:
+        logger.error(e)
+        logger.warning("Failed to verify token")
+        return 403, "Authentication failed!", None
+
+    # Get character data
+    character_data = auth.whoami()
+    character_id = character_data["character_id"]
+    character_name = character_data["character_name"]
+    scopes = character_data["scopes"]
+
+    # Create / Update user and store refresh_token
+    user, user_created = User.get_or_create(user_id=challenge.user.user_id)
+
+    if scopes == "esi-assets.read_corporation_assets.v1":
+
+        corporation_id = preston.get_op('get_characters_character_id', character_id=character_id).get(
+            "corporation_id")
+
+        corporation_character, created = CorporationCharacter.get_or_create(
+            character_id=character_id, user=user,
+            defaults={"corporation_id": corporation_id, "token": auth.refresh_token}
+        )
+        corporation_character.corporation_id = corporation_id
+        corporation_character.token = auth.refresh_token
+        corporation_character.save()
+
+    elif scopes == "esi-assets.read_assets.v1":
+        character, created = Character.get_or_create(
+            character_id=character_id, user=user,
+            defaults={"token": auth.refresh_token}
+        )
+        character.token = auth.refresh_token
+        character.save()
+
+    else:
+        return 400, f"Invalid scope for {character_name}!", None
+
+    logger.info(f"Added character {character_id}")
+    if created:
+        return 200, f"Successfully authenticated {character_name}!", auth
+    else:
+        return 200, f"Successfully re-authenticated {character_name}!", auth
+
+
+def prime_assets(preston: Preston, auth: Preston):
+    """Fetches the assets of a freshly added character, so the first command can use the cached snapshot."""
+    assets = Assets(auth, preston)
+    assets.sync_fetch()
+    snapshots.put(assets)
+    return assets
+
+
+async def prime(preston: Preston, auth: Preston):
+    async with prime_semaphore:
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(None, prime_assets, preston, auth)
+        except Exception as e:
+            logger.warning(f"Failed to prime assets: {e}")
+
+
 @tasks.loop()
 async def callback_server(preston: Preston):
     routes = web.RouteTableDef()
@@ -25,58 +114,17 @@ async def callback_server(preston: Preston):
         code = request.query.get('code')
         state = request.query.get('state')
 
-        # Verify the state and get the user ID
-        challenge = Challenge.get_or_none(Challenge.state == state)
-        if not challenge:
-            logger.warning("Failed to verify challenge")
-            return web.Response(text="Authentication failed: State mismatch", status=403)
+        # Authentication and database writes block, so they run in the executor
+        async with callback_semaphore:
+            loop = asyncio.get_event_loop()
+            status, text, auth = await loop.run_in_executor(None, register_character, preston, code, state)
 
-        # Authenticate using the code
-        try:
-            auth = preston.authenticate(code)
-        except Exception as e:
-            logger.error(e)
-            logger.warning("Failed to verify token")
-            return web.Response(text="Authentication failed!", status=403)
-
-        # Get character data
-        character_data = auth.whoami()
-        character_id = character_data["character_id"]
-        character_name = character_data["character_name"]
-        scopes = character_data["scopes"]
-
-        # Create / Update user and store refresh_token
-        user, user_created = User.get_or_create(user_id=challenge.user.user_id)
-
-        if scopes == "esi-assets.read_corporation_assets.v1":
-
-            corporation_id = preston.get_op('get_characters_character_id', character_id=character_id).get(
-                "corporation_id")
-
-            corporation_character, created = CorporationCharacter.get_or_create(
-                character_id=character_id, user=user,
-                defaults={"corporation_id": corporation_id, "token": auth.refresh_token}
-            )
-            corporation_character.corporation_id = corporation_id
-            corporation_character.token = auth.refresh_token
-            corporation_character.save()
-
-        elif scopes == "esi-assets.read_assets.v1":
-            character, created = Character.get_or_create(
-                character_id=character_id, user=user,
-                defaults={"token": auth.refresh_token}
-            )
-            character.token = auth.refresh_token
-            character.save()
-
-        else:
-            return web.Response(text=f"Invalid scope for {character_name}!", status=400)
-
-        logger.info(f"Added character {character_id}")
-        if created:
-            return web.Response(text=f"Successfully authenticated {character_name}!")
-        else:
-            return web.Response(text=f"Successfully re-authenticated {character_name}!")
+        if auth is not None:
+            task = asyncio.create_task(prime(preston, auth))
+            background_tasks.add(task)
+            task.add_done_callback(background_tasks.discard)
+
+        return web.Response(text=text, status=status)
 
     app = web.Application()
     app.add_routes(routes)
@@ -0,0 +1,169 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from requests.exceptions import RequestException
+
+logger = logging.getLogger("discord.main.esi_spec")
+
+SPEC_PATH = "data/esi_spec.json"
+
+# Bump whenever the layout of the cache file changes, so old files are ignored
+SPEC_FORMAT = 1
+
+# After this many seconds the cached spec is still used, but refreshed in the background
+SPEC_MAX_AGE = 24 * 60 * 60
+
+# An unknown operation triggers a new download at most this often
+SPEC_MISS_REFRESH_INTERVAL = 10 * 60
+
+METHODS = ["get", "post", "put", "delete"]
+
+# The operation spec shared by all Preston clients of this process and the path of each operation in it
+spec = {}
+operation_paths = {}
+
+# Unauthenticated client used to download the spec again
+source = None
+last_refresh = 0.0
+refresh_lock = threading.Lock()
+
+
+def reduce_spec(full_spec):
+    """Strips the OpenAPI spec down to what is needed to look up the path of an operation."""
+    paths = {}
+    for path, path_value in full_spec.get("paths", {}).items():
+        operations = {
+            method: {"operationId": path_value[method]["operationId"]}
+            for method in METHODS
+            if method in path_value and "operationId" in path_value[method]
+        }
+        if operations:
+            paths[path] = operations
+
+    return {"info": full_spec.get("info", {}), "basePath": full_spec.get("basePath", ""), "paths": paths}
+
+
+def read_cache(version):
+    """Returns the cache file contents if it matches the format and the requested ESI version."""
+    try:
+        with open(SPEC_PATH) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if not isinstance(cached, dict) or cached.get("format") != SPEC_FORMAT or cached.get("version") != version:
+        return None
+
+    if not cached.get("spec", {}).get("paths"):
+        return None
+
+    return cached
+
+
+def write_cache(version, reduced_spec):
+    cached = {
+        "format": SPEC_FORMAT,
+        "version": version,
+        "spec_version": reduced_spec["info"].get("version"),
+        "fetched_at": time.time(),
+        "spec": reduced_spec,
+    }
+
+    # Write to a temporary file first so a crash never leaves a broken cache behind
+    temporary_path = f"{SPEC_PATH}.tmp"
+    with open(temporary_path, "w") as f:
+        json.dump(cached, f)
+    os.replace(temporary_path, SPEC_PATH)
+
+
+def fetch(preston):
+    """Downloads the spec through the given client and stores the reduced version on disk."""
+    preston.spec = None
+    reduced_spec = reduce_spec(preston._get_spec())
+    if not reduced_spec["paths"]:
+        raise ValueError("ESI returned a spec without any operations")
+
+    write_cache(preston.version, reduced_spec)
+    return reduced_spec
+
+
+def use(new_spec):
+    global operation_paths
+
+    # Replace the keys in place, so clients using the shared spec never see it empty
+    spec.update(new_spec)
+    operation_paths = {
+        operation["operationId"]: path
+        for path, path_value in new_spec["paths"].items()
+        for operation in path_value.values()
+    }
+
+
+def refresh(preston):
+    """Downloads the spec again, returns whether that worked. Failures keep the current spec."""
+    global last_refresh
+    last_refresh = time.time()
+    old_version = spec.get("info", {}).get("version")
+
+    try:
+        new_spec = fetch(preston)
+    except (RequestException, OSError, AttributeError, TypeError, ValueError) as e:
+        logger.warning(f"Could not refresh ESI spec, keeping the current one: {e}")
+        return False
+
+    use(new_spec)
+    new_version = new_spec["info"].get("version")
+    if new_version != old_version:
+        logger.info(f"ESI spec changed from version {old_version} to {new_version}")
+    return True
+
+
+def get_path_for_op_id(preston, op_id):
+    """Looks up an operation in the shared spec, downloading the spec again if the operation is unknown."""
+    if op_id not in operation_paths and source is not None:
+        with refresh_lock:
+            if op_id not in operation_paths and time.time() - last_refresh > SPEC_MISS_REFRESH_INTERVAL:
+                refresh(source.copy())
+
+    if op_id in operation_paths:
+        return operation_paths[op_id]
+
+    # Without a usable shared spec the client loads its own, as Preston does by default
+    return type(preston)._get_path_for_op_id(preston, op_id)
+
+
+def load(*prestons):
+    """Loads the ESI spec from disk (or ESI if there is no usable cache) and shares it with the clients.
+
+    A cache that is older than SPEC_MAX_AGE is still used right away and refreshed in the background.
+    If there is no cache and ESI can't be reached, the clients load the spec lazily on first use.
+    """
+    global source
+
+    start = time.monotonic()
+    source = prestons[0]
+    cached = read_cache(source.version)
+
+    if cached is None:
+        if refresh(source.copy()):
+            logger.info(f"Fetched ESI spec in {time.monotonic() - start:.2f}s")
+    else:
+        use(cached["spec"])
+        logger.info(f"Loaded cached ESI spec version {cached.get('spec_version')} in {time.monotonic() - start:.2f}s")
+
+        if time.time() - cached.get("fetched_at", 0) > SPEC_MAX_AGE:
+            threading.Thread(target=refresh, args=(source.copy(),), daemon=True).start()
+
+    for preston in prestons:
+        attach(preston)
+
+
+def attach(preston):
+    """Lets a client use the shared spec instead of downloading its own."""
+    if spec:
+        preston.spec = spec
+    preston._get_path_for_op_id = lambda op_id: get_path_for_op_id(preston, op_id)
+    return preston
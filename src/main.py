@@ -1,3 +1,4 @@
+import asyncio
 import collections
 import logging
 import os
@@ -11,10 +12,13 @@ from discord import Interaction, app_commands
 from discord.ext import commands
 from preston import Preston
 
-from assets import Assets
+import esi_spec
+from assets import Assets, compile_requirements
 from callback_server import callback_server
 from models import initialize_database, User, Challenge, CorporationCharacter, Character
-from utils import lookup, command_error_handler
+from scheduled_check import scheduled_check, CHECK_INTERVAL_MINUTES
+from snapshot_cache import snapshots
+from utils import lookup, command_error_handler, update_requirements, MessageStream
 
 # Configure the logger
 logger = logging.getLogger('discord.main')
@@ -57,6 +61,9 @@ corp_base_preston = Preston(
     timeout=6,
 )
 
+# Both clients share one ESI spec, which is cached on disk so restarts don't need to download it
+esi_spec.load(base_preston, corp_base_preston)
+
 # Setup Discord
 intents = discord.Intents.default()
 intents.messages = True
@@ -64,28 +71,59 @@ intents.message_content = True
 bot = commands.Bot(command_prefix="/", intents=intents)
 
 
+def load_assets(preston, token, owner_key):
+    """Returns the cached snapshot of an owner if ESI has no newer data, otherwise fetches a new one."""
+    assets = snapshots.get(owner_key)
+    if assets is None:
+        assets = Assets(esi_spec.attach(preston.authenticate_from_token(token)), base_preston)
+        assets.sync_fetch()
+        snapshots.put(assets)
+    return assets
+
+
+async def get_character_assets(character):
+    loop = asyncio.get_event_loop()
+    owner_key = ("character", str(character.character_id))
+    return await loop.run_in_executor(None, load_assets, base_preston, character.token, owner_key)
+
+
+async def get_corporation_assets(corporation_character):
+    loop = asyncio.get_event_loop()
+    owner_key = ("corporation", str(corporation_character.corporation_id), str(corporation_character.character_id))
+    try:
+        return await loop.run_in_executor(None, load_assets, corp_base_preston, corporation_character.token, owner_key)
+    except AssertionError:
+        corporation_character.delete_instance()
+        return None
+
+
+def get_owner_count(user):
+    return user.characters.count() + user.corporation_characters.count()
+
+
 async def get_author_assets(author_id: str):
-    user = User.get_or_none(User.user_id == author_id)
+    """Fetches the assets of all owners of a user at once and yields them in the order they finish."""
+    user = User.get_or_none(User.user_id == str(author_id))
     if user:
-        for character in user.characters:
-            a = Assets(base_preston.authenticate_from_token(character.token))
-            await a.fetch()
-            yield a
-
-        for corporation_character in user.corporation_characters:
-            try:
-                a = Assets(corp_base_preston.authenticate_from_token( corporation_character.token))
-                await a.fetch()
-            except AssertionError:
-                corporation_character.delete_instance()
-            else:
-                yield a
+        tasks = [asyncio.create_task(get_character_assets(c)) for c in user.characters]
+        tasks += [asyncio.create_task(get_corporation_assets(c)) for c in user.corporation_characters]
+
+        try:
+            for task in asyncio.as_completed(tasks):
+                a = await task
+                if a is not None:
+                    yield a
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        logger.info(f"Snapshot cache: {snapshots.stats()}")
 
-def update_requirements(user):
-    if user.update_url is not None:
-        response = requests.get(user.update_url, allow_redirects=True)
-        user.requirements_file = response.text
-        user.save()
+
+async def get_compiled_requirements(user):
+    """Resolves the item names of the requirements file once, so all owners can be checked by type id."""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, compile_requirements, base_preston, user.requirements_file)
 
 
 @bot.event
@@ -98,16 +136,20 @@ async def on_ready():
         logger.error(f"Failed to sync commands: {e}", exc_info=True)
     callback_server.start(base_preston)
 
+    if CHECK_INTERVAL_MINUTES > 0 and not scheduled_check.is_running():
+        scheduled_check.start(bot, base_preston, get_character_assets, get_corporation_assets)
+
 
 @bot.tree.command(name="state", description="Returns current ship state in YAML format.")
 @command_error_handler
 async def state(interaction: Interaction):
     await interaction.response.defer(ephemeral=True)
     files_to_send = []
+    loop = asyncio.get_event_loop()
 
     async for assets in get_author_assets(interaction.user.id):
         filename = f"{assets.corporation_name if assets.is_corporation else assets.character_name}.yaml"
-        yaml_text = assets.save_requirement()
+        yaml_text = await loop.run_in_executor(None, assets.save_requirement)
         file = discord.File(StringIO(yaml_text), filename=filename)
         files_to_send.append(file)
 
@@ -125,49 +167,58 @@ async def check(interaction: Interaction):
     user = User.get_or_none(User.user_id == str(interaction.user.id))
 
     if user is None:
-        await interaction.response.send_message("You are not a registered user!")
+        await interaction.followup.send("You are not a registered user!", ephemeral=True)
         return
 
     update_requirements(user)
 
     if user.requirements_file is None:
-        await interaction.response.send_message("You have not set a requirements file, use the !set command and upload one!")
+        await interaction.followup.send("You have not set a requirements file, use the !set command and upload one!", ephemeral=True)
         return
 
-    has_characters = False
+    owner_count = get_owner_count(user)
+    if owner_count == 0:
+        await interaction.followup.send("You have no authorized characters!", ephemeral=True)
+        return
+
+    try:
+        requirements = await get_compiled_requirements(user)
+    except ValueError as e:
+        await interaction.followup.send(f"Your requirements file could not be used: {e}", ephemeral=True)
+        return
+
+    loop = asyncio.get_event_loop()
+    stream = MessageStream(interaction)
+    stream.status = f"Checking {owner_count} owners..."
+    stream.schedule()
+
+    checked = 0
     has_errors = False
-    message = ""
 
-    async for assets in get_author_assets(str(interaction.user.id)):
-        has_characters = True
-        name = f"\n## {assets.corporation_name if assets.is_corporation else assets.character_name}:\n"
-        user = User.get_or_none(User.user_id == str(interaction.user.id))
+    try:
+        async for assets in get_author_assets(str(interaction.user.id)):
+            checked += 1
+            ship_error_messages = await loop.run_in_executor(None, list, assets.check_requirement(requirements))
 
-        if user and user.requirements_file:
-            for ship_error_message in assets.check_requirement(user.requirements_file):
+            if ship_error_messages:
                 has_errors = True
-                if len(message) + len(ship_error_message) + len(name) > 1990:
-                    await interaction.followup.send(message)
-                    message = ""
-                if name:
-                    message += name
-                    name = ""
-                message += f"{ship_error_message}\n"
-        else:
-            await interaction.followup.send(
-                "You have not set a requirements file. Use `/set` and upload one!", ephemeral=True
-            )
+                name = f"\n## {assets.corporation_name if assets.is_corporation else assets.character_name}:\n"
+                await stream.write(name + "".join(f"{ship_error_message}\n" for ship_error_message in ship_error_messages))
 
-    if not has_characters:
-        await  interaction.followup.send("You have no authorized characters!", ephemeral=True)
-        return
+            stream.status = f"Checked {checked}/{owner_count} owners..."
+            stream.schedule()
 
+        stream.status = f"Checked {checked} owners."
+        await stream.close()
+    finally:
+        stream.cancel()
 
-    if has_errors:
-        await interaction.followup.send(message, ephemeral=True)
-    else:
-        await interaction.followup.send("**No State Errors found!**", ephemeral=True)
+    if checked == 0:
+        await interaction.followup.send("You have no authorized characters!", ephemeral=True)
+        return
 
+    if not has_errors:
+        await interaction.followup.send("**No State Errors found!**", ephemeral=True)
 
 
 @bot.tree.command(name="buy", description="Returns a multibuy of missing items in your ships.")
@@ -188,11 +239,18 @@ async def buy(interaction: Interaction):
         await interaction.followup.send("You have not set a requirements file, use the !set command and upload one!")
         return
 
+    try:
+        requirements = await get_compiled_requirements(user)
+    except ValueError as e:
+        await interaction.followup.send(f"Your requirements file could not be used: {e}", ephemeral=True)
+        return
+
+    loop = asyncio.get_event_loop()
     async for assets in get_author_assets(interaction.user.id):
         has_characters = True
         user = User.get_or_none(User.user_id == str(interaction.user.id))
         if user and user.requirements_file:
-            buy_list = assets.get_buy_list(user.requirements_file, buy_list=buy_list)
+            buy_list = await loop.run_in_executor(None, assets.get_buy_list, requirements, buy_list)
         else:
             await interaction.followup.send(
                 "You have not set a requirements file. Use `/set` and upload one!", ephemeral=True
@@ -294,12 +352,12 @@ async def characters(interaction: Interaction):
         return
         
     for character in user.characters:
-        char_auth = base_preston.authenticate_from_token(character.token)
+        char_auth = esi_spec.attach(base_preston.authenticate_from_token(character.token))
         name = char_auth.whoami()['character_name']
         character_names.append(f"- {name}")
 
     for corp_character in user.corporation_characters:
-        char_auth = corp_base_preston.authenticate_from_token(corp_character.token)
+        char_auth = esi_spec.attach(corp_base_preston.authenticate_from_token(corp_character.token))
         char_name = char_auth.whoami()['character_name']
         corp_name = char_auth.get_op("get_corporations_corporation_id",
                                      corporation_id=corp_character.corporation_id).get("name")
@@ -390,7 +448,7 @@ async def revoke(
                 for corp_character in user_corp_characters:
                     corp_character.delete_instance()
 
-            user.delete_instance()
+            user.delete_instance(recursive=True)
             await interaction.response.send_message("Successfully revoked access to all your characters.")
 
 
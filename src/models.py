@@ -34,6 +34,31 @@ class Challenge(BaseModel):
     state = CharField()
 
 
+class ContainerState(BaseModel):
+    """Items that were missing from a container at the last scheduled check"""
+    user = ForeignKeyField(User, backref='container_states')
+    owner = CharField()
+    item_id = CharField()
+    name = TextField()
+    missing = TextField()
+
+    class Meta:
+        indexes = (
+            (('user', 'owner', 'item_id'), True),
+        )
+
+
+class CheckedOwner(BaseModel):
+    """Character or corporation of a user that has been through a scheduled check"""
+    user = ForeignKeyField(User, backref='checked_owners')
+    owner = CharField()
+
+    class Meta:
+        indexes = (
+            (('user', 'owner'), True),
+        )
+
+
 def initialize_database():
     with db:
-        db.create_tables([User, Character, CorporationCharacter, Challenge])
+        db.create_tables([User, Character, CorporationCharacter, Challenge, ContainerState, CheckedOwner])
@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import os
+import time
+
+from discord.ext import tasks
+
+from assets import compile_requirements, format_missing, resolve_type_names
+from models import db, User, ContainerState, CheckedOwner
+from utils import update_requirements, split_message
+
+# Configure the logger
+logger = logging.getLogger('discord.main.scheduled_check')
+logger.setLevel(logging.INFO)
+
+# Minutes in between scheduled checks, 0 disables them
+CHECK_INTERVAL_MINUTES = int(os.environ.get("CHECK_INTERVAL_MINUTES", 0))
+
+# ESI requests a single run may use, the remaining users are checked in the next run
+CHECK_ESI_BUDGET = int(os.environ.get("CHECK_ESI_BUDGET", 500))
+
+# Users loaded from the database at once
+CHECK_BATCH_SIZE = int(os.environ.get("CHECK_BATCH_SIZE", 20))
+
+# Requests a snapshot fetch is assumed to make until the actual number is known
+ESTIMATED_FETCH_CALLS = 10
+
+# Seconds a single user may take before their check is given up for this run
+CHECK_USER_TIMEOUT = int(os.environ.get("CHECK_USER_TIMEOUT", 300))
+
+# Post changes to this channel instead of sending them as direct messages
+NOTIFICATION_CHANNEL_ID = os.environ.get("NOTIFICATION_CHANNEL_ID")
+
+# The last user that was checked, so the next run continues after them
+cursor = ""
+
+
+def diff_container_states(user, assets, missing):
+    """Compares what is missing from each container of an owner with the last check.
+
+    Returns a description of all changes and the new states to store. Nothing is reported the first
+    time an owner is checked, so existing problems don't cause a notification.
+    """
+    owner = ":".join(assets.owner_key)
+    is_new_owner = not CheckedOwner.select().where(
+        (CheckedOwner.user == user) & (CheckedOwner.owner == owner)
+    ).exists()
+    previous = {state.item_id: state.missing for state in ContainerState.select().where(
+        (ContainerState.user == user) & (ContainerState.owner == owner)
+    )}
+
+    changes = ""
+    states = []
+    for ship, difference in missing:
+        item_id = str(ship.item_id)
+        missing_text = format_missing(difference)
+        states.append({"user": user, "owner": owner, "item_id": item_id, "name": ship.full_name, "missing": missing_text})
+
+        if item_id not in previous:
+            if not is_new_owner and missing_text:
+                changes += f"### {ship.full_name}:{missing_text}\n"
+
+        elif previous[item_id] != missing_text:
+            if missing_text:
+                changes += f"### {ship.full_name}:{missing_text}\n"
+            else:
+                changes += f"### {ship.full_name}:\n- All requirements met\n"
+
+    return changes, states
+
+
+def store_container_states(user, owner_states):
+    """Replaces the stored states of a user with the ones of the owners that were just checked."""
+    owners = list(owner_states)
+    with db.atomic():
+        # Owners that are no longer linked are forgotten as well
+        ContainerState.delete().where(ContainerState.user == user).execute()
+        CheckedOwner.delete().where((CheckedOwner.user == user) & (CheckedOwner.owner.not_in(owners))).execute()
+
+        for owner, states in owner_states.items():
+            CheckedOwner.get_or_create(user=user, owner=owner)
+            if states:
+                ContainerState.insert_many(states).execute()
+
+
+def get_missing(assets, requirements, preston):
+    """Returns what is missing from each container and the number of ESI requests made to name those items."""
+    missing = [(ship, contents - ship.type_id_counts) for ship, contents in assets.matched_containers(requirements)]
+    esi_calls = resolve_type_names(preston, [key for ship, difference in missing for key in difference if isinstance(key, int)])
+    return missing, esi_calls
+
+
+async def notify(bot, user, text):
+    if NOTIFICATION_CHANNEL_ID:
+        channel = bot.get_channel(int(NOTIFICATION_CHANNEL_ID)) or await bot.fetch_channel(int(NOTIFICATION_CHANNEL_ID))
+        text = f"<@{user.user_id}> your ship states changed:\n{text}"
+    else:
+        channel = await bot.fetch_user(int(user.user_id))
+        text = f"Your ship states changed:\n{text}"
+
+    for message in split_message(text):
+        await channel.send(message)
+
+
+class Budget:
+    """Keeps track of the ESI requests a run has made and may still make."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+
+    @property
+    def spent(self):
+        return self.used >= self.limit
+
+
+async def check_user(bot, preston, get_character_assets, get_corporation_assets, user, run_start, budget):
+    """Checks the owners of a user one by one and notifies them about changes.
+
+    Requests are added to the budget as they are made. Once it is spent no further owners are fetched and
+    False is returned, so the user is checked again from the start in the next run.
+    """
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, update_requirements, user)
+    if user.requirements_file is None:
+        return True
+
+    try:
+        requirements = await loop.run_in_executor(None, compile_requirements, preston, user.requirements_file)
+    except ValueError:
+        return True
+    budget.used += requirements.esi_calls
+
+    owners = [(get_character_assets, c) for c in user.characters]
+    owners += [(get_corporation_assets, c) for c in user.corporation_characters]
+    owner_states = {}
+    text = ""
+
+    for get_assets, owner in owners:
+        if budget.spent:
+            return False
+
+        # Reserve the usual cost of a fetch, so it stays counted if the fetch outlives a timeout in its thread
+        budget.used += ESTIMATED_FETCH_CALLS
+        assets = await get_assets(owner)
+        budget.used -= ESTIMATED_FETCH_CALLS
+        if assets is None:
+            continue
+
+        # Snapshots taken from the cache did not cost any requests in this run
+        if assets.fetched_at is not None and assets.fetched_at >= run_start:
+            budget.used += assets.esi_calls
+
+        missing, lookup_calls = await loop.run_in_executor(None, get_missing, assets, requirements, preston)
+        budget.used += lookup_calls
+        changes, owner_states[":".join(assets.owner_key)] = diff_container_states(user, assets, missing)
+        if changes:
+            text += f"\n## {assets.corporation_name if assets.is_corporation else assets.character_name}:\n{changes}"
+
+    # The new states are only stored once the user was told about them, so a failed message is sent again next time
+    if text:
+        await notify(bot, user, text)
+    store_container_states(user, owner_states)
+
+    return True
+
+
+@tasks.loop(minutes=CHECK_INTERVAL_MINUTES or 60)
+async def scheduled_check(bot, preston, get_character_assets, get_corporation_assets):
+    """Checks users with requirements in batches until the ESI budget of this run is used up."""
+    global cursor
+
+    run_start = time.time()
+    budget = Budget(CHECK_ESI_BUDGET)
+    checked = set()
+    finished = False
+
+    while not finished:
+        users = list(User.select().where(
+            (User.user_id > cursor) & (User.requirements_file.is_null(False) | User.update_url.is_null(False))
+        ).order_by(User.user_id).limit(CHECK_BATCH_SIZE))
+
+        # Start from the beginning once all users were checked
+        if not users:
+            finished = cursor == ""
+            cursor = ""
+            continue
+
+        for user in users:
+            if user.user_id in checked or budget.spent:
+                finished = True
+                break
+
+            complete = True
+            try:
+                complete = await asyncio.wait_for(
+                    check_user(bot, preston, get_character_assets, get_corporation_assets, user, run_start, budget),
+                    CHECK_USER_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                logger.error(f"Scheduled check of {user.user_id} timed out")
+            except Exception as e:
+                logger.error(f"Scheduled check of {user.user_id} failed: {e}", exc_info=True)
+
+            checked.add(user.user_id)
+
+            # Continue with the same user in the next run if the budget ran out halfway through them
+            if not complete:
+                finished = True
+                break
+            cursor = user.user_id
+
+    logger.info(f"Scheduled check of {len(checked)} users used about {budget.used} ESI requests")
@@ -0,0 +1,77 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger("discord.main.snapshot_cache")
+
+
+class SnapshotCache:
+    """Keeps processed Assets snapshots in memory, so consecutive commands don't have to build them again.
+
+    Snapshots are dropped once ESI would return new data for them. When the approximate size of all
+    snapshots exceeds the byte budget, the least recently used ones are evicted.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0].expires <= time.time():
+                self._remove(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, assets):
+        size = assets.approximate_size
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            key = assets.owner_key
+            if key in self.entries:
+                self._remove(key)
+
+            self.entries[key] = (assets, size)
+            self.size += size
+            self._evict()
+
+    def _remove(self, key):
+        assets, size = self.entries.pop(key)
+        self.size -= size
+
+    def _evict(self):
+        now = time.time()
+        for key in [key for key, (assets, size) in self.entries.items() if assets.expires <= now]:
+            self._remove(key)
+            self.evictions += 1
+
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            hit_rate = self.hits / lookups if lookups else 0
+            return (f"{len(self.entries)} snapshots, {self.size / 1024 / 1024:.1f}/{self.max_bytes / 1024 / 1024:.0f} MiB, "
+                    f"{self.hits} hits, {self.misses} misses ({hit_rate:.0%}), {self.evictions} evictions")
+
+
+snapshots = SnapshotCache(int(os.environ.get("SNAPSHOT_CACHE_BYTES", 256 * 1024 * 1024)))
@@ -1,5 +1,8 @@
+import asyncio
 import logging
+import time
 
+import requests
 from preston import Preston
 
 logger = logging.getLogger("discord.main.utils")
@@ -35,6 +38,25 @@ async def lookup(preston, string, return_type):
             raise ValueError("Could not parse that character!")
 
 
+def split_message(text, limit=1990):
+    """Splits text into chunks that fit into a discord message, preferably at line breaks."""
+    while text:
+        cut = len(text)
+        if cut > limit:
+            cut = text.rfind("\n", 0, limit)
+            if cut <= 0:
+                cut = limit
+        yield text[:cut]
+        text = text[cut:]
+
+
+def update_requirements(user):
+    if user.update_url is not None:
+        response = requests.get(user.update_url, allow_redirects=True)
+        user.requirements_file = response.text
+        user.save()
+
+
 def command_error_handler(func):
     """Decorator for handling bot command logging and exceptions."""
 
@@ -49,3 +71,64 @@ def command_error_handler(func):
             logger.error(f"Error in /{func.__name__} command: {e}", exc_info=True)
 
     return wrapper
+
+
+class MessageStream:
+    """Streams output of a deferred interaction as few followup messages as possible.
+
+    Output is collected until the rate limit interval since the last send has passed, then all of it
+    is sent at once. The status line replaces the content of the deferred response to show progress.
+    """
+
+    def __init__(self, interaction, interval=1.5, limit=1990):
+        self.interaction = interaction
+        self.interval = interval
+        self.limit = limit
+        self.pending = ""
+        self.status = ""
+        self.sent_status = ""
+        self.last_sent = 0.0
+        self.lock = asyncio.Lock()
+        self.scheduled = None
+
+    async def write(self, text):
+        """Queues text, sending the earlier output first if the message would get too long."""
+        if self.pending and len(self.pending) + len(text) > self.limit:
+            await self.flush()
+        self.pending += text
+        self.schedule()
+
+    def schedule(self):
+        """Makes sure pending output and status are sent once the interval has passed."""
+        if self.scheduled is None or self.scheduled.done():
+            delay = max(0.0, self.last_sent + self.interval - time.monotonic())
+            self.scheduled = asyncio.create_task(self._flush_later(delay))
+
+    async def _flush_later(self, delay):
+        await asyncio.sleep(delay)
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Failed to send streamed output: {e}", exc_info=True)
+
+    async def flush(self):
+        async with self.lock:
+            if self.status != self.sent_status:
+                self.sent_status = self.status
+                await self.interaction.edit_original_response(content=self.status)
+
+            pending, self.pending = self.pending, ""
+            for message in split_message(pending, self.limit):
+                await self.interaction.followup.send(message, ephemeral=True)
+
+            self.last_sent = time.monotonic()
+
+    async def close(self):
+        """Sends everything that is still pending right away."""
+        await self.flush()
+        self.cancel()
+
+    def cancel(self):
+        """Stops a scheduled send, e.g. when the command failed halfway."""
+        if self.scheduled is not None:
+            self.scheduled.cancel()